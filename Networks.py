@@ -3,11 +3,13 @@ import torch.nn as nn
 
 class BaselineConvNet(nn.Module):
 
-    def __init__(self, classification=False, avg_embeddings=False, lead_grouping=False):
+    def __init__(self, classification=False, avg_embeddings=False, lead_grouping=False, bn_before_activation=False):
         super(BaselineConvNet, self).__init__()
         self.classification = classification
         self.avg_embeddings = avg_embeddings
         self.lead_grouping = lead_grouping
+        # checkpoints trained before this option existed apply the batch norm after the activation
+        self.bn_before_activation = bn_before_activation
         self.conv1 = nn.Conv1d(in_channels=1, 
                                out_channels=16, 
                                kernel_size=7, 
@@ -56,6 +58,67 @@ class BaselineConvNet(nn.Module):
 
         )
     
+    def trunk(self, x):
+        for k in range(1, 7):
+            conv = getattr(self, f'conv{k}')
+            batch_norm = getattr(self, f'batch_norm{k}')
+            if self.bn_before_activation:
+                x = self.activation(batch_norm(conv(x)))
+            else:
+                x = batch_norm(self.activation(conv(x)))
+        return x
+
+    @torch.no_grad()
+    def fuse_for_eval(self):
+
+        """ Folds every batch norm into a neighbouring layer and replaces it with nn.Identity.
+        With bn_before_activation, batch_normK is folded into the preceding convK. Otherwise the batch norm
+        sits after the activation, so batch_normK is absorbed into conv(K+1) (the convs are unpadded, which
+        keeps this exact) and batch_norm6 into the first Linear of finalLayer, since the average pooling
+        commutes with the affine transform. Only valid in eval mode.
+        Returns:
+            self
+        """
+
+        assert not self.training, "fuse_for_eval() uses the running statistics, call model.eval() first"
+
+        if self.bn_before_activation:
+            for k in range(1, 7):
+                conv = getattr(self, f'conv{k}')
+                batch_norm = getattr(self, f'batch_norm{k}')
+                if not isinstance(batch_norm, nn.BatchNorm1d):
+                    continue
+
+                scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+                conv.weight.mul_(scale.view(-1, 1, 1))
+                conv.bias.sub_(batch_norm.running_mean).mul_(scale).add_(batch_norm.bias)
+
+                setattr(self, f'batch_norm{k}', nn.Identity())
+
+            return self
+
+        # finalLayer may have been swapped out (e.g. for nn.Identity), in which case batch_norm6 is kept
+        last = self.finalLayer[0] if isinstance(self.finalLayer, nn.Sequential) else None
+        if not isinstance(last, nn.Linear):
+            last = None
+        consumers = [self.conv2, self.conv3, self.conv4, self.conv5, self.conv6, last]
+
+        for k, layer in enumerate(consumers, start=1):
+            batch_norm = getattr(self, f'batch_norm{k}')
+            if layer is None or not isinstance(batch_norm, nn.BatchNorm1d):
+                continue
+
+            scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+            shift = batch_norm.bias - batch_norm.running_mean * scale
+
+            weight = layer.weight.view(layer.weight.shape[0], layer.weight.shape[1], -1)
+            layer.bias.add_((weight * shift.view(1, -1, 1)).sum(dim=(1, 2)))
+            weight.mul_(scale.view(1, -1, 1))
+
+            setattr(self, f'batch_norm{k}', nn.Identity())
+
+        return self
+
     def forward(self, x):
 
         """ Forward Pass
@@ -65,38 +128,13 @@ class BaselineConvNet(nn.Module):
             h(torch.Tensor): Output tensor of shape (batch_size, 1, 128) if avg_embeddings is True else (batch_size, 8, 128) and (batch_size, 1) if classification is True else (batch_size, 1) if classification
         """
         
-        batch_size = x.shape[0]
-        nviews = x.shape[1]
+        batch_size, nviews, samples = x.shape
         if self.classification:
             self.avg_embeddings = True
 
-        # h = X.view(-1, 1, samples)
-
-        # x_i = self.batch_norm1(self.activation(self.conv1(h)))
-        # x_i = self.batch_norm2(self.activation(self.conv2(x_i)))
-        # x_i = self.batch_norm3(self.activation(self.conv3(x_i)))
-        # x_i = self.batch_norm4(self.activation(self.conv4(x_i)))
-        # x_i = self.batch_norm5(self.activation(self.conv5(x_i)))
-        # x_i = self.batch_norm6(self.activation(self.conv6(x_i)))
-        # x_i = self.avg_pool(x_i)
-        # x_i = nn.Flatten()(x_i)
-        # h = x_i.view(batch_size, nviews, -1)
-
-        h = torch.empty(batch_size, nviews, 256, device=x.device)
-
-        for i in range(nviews):
-            x_i = x[:, i, :].unsqueeze(1)
-
-            x_i = self.batch_norm1(self.activation(self.conv1(x_i)))
-            x_i = self.batch_norm2(self.activation(self.conv2(x_i)))
-            x_i = self.batch_norm3(self.activation(self.conv3(x_i)))
-            x_i = self.batch_norm4(self.activation(self.conv4(x_i)))
-            x_i = self.batch_norm5(self.activation(self.conv5(x_i)))
-            x_i = self.batch_norm6(self.activation(self.conv6(x_i)))
-            x_i = self.avg_pool(x_i)
-            x_i = nn.Flatten()(x_i)
-
-            h[:, i, :] = x_i
+        # every lead goes through the same trunk, so fold the views into the batch
+        h = self.trunk(x.reshape(batch_size * nviews, 1, samples))
+        h = self.avg_pool(h).flatten(1).view(batch_size, nviews, 256)
 
         if self.lead_grouping:
             h_0 = h[:,[0,1,6,7],:]
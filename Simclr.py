@@ -6,7 +6,6 @@ import numpy as np
 from itertools import combinations
 import torch
 import torch.nn.functional as F
-from torch.cuda.amp import GradScaler, autocast
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from utils import save_config_file, accuracy, save_checkpoint
@@ -21,7 +20,6 @@ class AverageMeter:
 
     def reset(self):
         self.val = 0
-        self.avg = 0
         self.sum = 0
         self.count = 0
 
@@ -29,7 +27,42 @@ class AverageMeter:
         self.val = val
         self.sum += val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+class CUDAPrefetcher:
+    """Iterates over a loader, copying the next batch of views to the device on a side stream while the current one is in use"""
+    def __init__(self, loader):
+        self.loader = loader
+        self.stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            if self.stream is not None:
+                torch.cuda.current_stream().wait_stream(self.stream)
+                for view in next_batch[0]:
+                    view.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+            next_batch = self.preload(batches)
+            yield batch
+
+    def preload(self, batches):
+        try:
+            images, patientIds = next(batches)
+        except StopIteration:
+            return None
+
+        if self.stream is None:
+            return [view.to(device) for view in images], patientIds
+        with torch.cuda.stream(self.stream):
+            return [view.to(device, non_blocking=True) for view in images], patientIds
 
 class SimCLR(object):
 
@@ -48,9 +81,16 @@ class SimCLR(object):
         self.temperature = args.temperature
         self.warmup_epochs = args.warmup_epochs
         self.checkpoint_freq = args.checkpoint_freq
+        self.log_every = 20
         
         self.n_views = 2
-        self.fp16_precision = False
+        # native bf16 tensor cores start with Ampere, older GPUs would only emulate it
+        self.bf16_precision = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+
+        # input shapes are fixed, so let cudnn pick the fastest algorithms and use TF32 for whatever stays in fp32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
 
         self.writer = SummaryWriter(comment=f"_{args.arch}")
         logging.basicConfig(filename=os.path.join(self.writer.log_dir, 'training.log'), level=logging.DEBUG)
@@ -59,99 +99,95 @@ class SimCLR(object):
         print(f"Logging has been saved at {self.writer.log_dir}.")
         self.criterion = torch.nn.CrossEntropyLoss().to(device)
 
-    def info_nce_loss(self, features):
-
+        # the info_nce_loss masks only depend on the (fixed) batch size and number of views
         labels = torch.cat([torch.arange(self.batch_size) for i in range(self.n_views)], dim=0)
-        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-        labels = labels.to(device)
+        labels = labels.unsqueeze(0) == labels.unsqueeze(1)
+        mask = torch.eye(labels.shape[0], dtype=torch.bool)
+        self.info_nce_diag_mask = mask.to(device)
+        self.info_nce_positives_mask = labels[~mask].view(labels.shape[0], -1).to(device)
+        self.info_nce_labels = torch.zeros(labels.shape[0], dtype=torch.long).to(device)
+
+        # index pairs of views compared by contrastive_loss, keyed by the number of views
+        self.view_pairs = {}
+
+    def info_nce_loss(self, features):
 
         features = F.normalize(features, dim=1)
 
         similarity_matrix = torch.matmul(features, features.T)
         # assert similarity_matrix.shape == (
         #     self.n_views * batch_size, self.n_views * batch_size)
-        # assert similarity_matrix.shape == labels.shape
 
-        # discard the main diagonal from both: labels and similarities matrix
-        mask = torch.eye(labels.shape[0], dtype=torch.bool).to(device)
-        labels = labels[~mask].view(labels.shape[0], -1)
-        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-        # assert similarity_matrix.shape == labels.shape
+        # discard the main diagonal from the similarities matrix
+        similarity_matrix = similarity_matrix[~self.info_nce_diag_mask].view(similarity_matrix.shape[0], -1)
 
         # select and combine multiple positives
-        positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
+        positives = similarity_matrix[self.info_nce_positives_mask].view(similarity_matrix.shape[0], -1)
 
         # select only the negatives the negatives
-        negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
+        negatives = similarity_matrix[~self.info_nce_positives_mask].view(similarity_matrix.shape[0], -1)
 
         logits = torch.cat([positives, negatives], dim=1)
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).to(device)
 
         logits = logits / self.temperature
-        return logits, labels
+        return logits, self.info_nce_labels
 
     def contrastive_loss(self, features, patientIds):
-        pids = np.array(patientIds, dtype=object)
-        pid1, pid2 = np.meshgrid(pids, pids)
-        pid_matrix = pid1 + '-' + pid2
-        pids_of_interest = np.unique(pids+'-'+pids)
-        bool_matrix_of_interest = np.isin(pid_matrix, pids_of_interest).astype(int)
-
-        rows1, cols1 = np.where(np.triu(bool_matrix_of_interest, k=1))
-        rows2, cols2 = np.where(np.tril(bool_matrix_of_interest, k=-1))
-
-        nviews = set(range(features.shape[1]))
-        view_combinations = combinations(nviews, 2)
-
-        loss = 0
-        ncombinations = 0
-
-        for lead1, lead2 in view_combinations:
-            view1_array = features[:, lead1, :]
-            view2_array = features[:, lead2, :]
-
-            norm1_vector = view1_array.norm(dim=1, keepdim=True)
-            norm2_vector = view2_array.norm(dim=1, keepdim=True)
-
-            sim_matrix = torch.mm(view1_array, view2_array.t())
-            norm_matrix = torch.mm(norm1_vector, norm2_vector.t())
-            
-            temperature=0.1
-            argument = sim_matrix / (norm_matrix * temperature)
-            sim_matrix_exp = torch.exp(argument)
-
-            triu_elements = sim_matrix_exp[rows1, cols1]
-            tril_elements = sim_matrix_exp[rows2, cols2]
-            diag_elements = torch.diag(sim_matrix_exp)
-            
-            triu_sum = torch.sum(sim_matrix_exp, dim=1)
-            tril_sum = torch.sum(sim_matrix_exp, dim=0)
-
-            loss_diag1 = -torch.mean(torch.log(diag_elements / triu_sum))
-            loss_diag2 = -torch.mean(torch.log(diag_elements / tril_sum))
-
-            loss_triu = -torch.mean(torch.log(triu_elements / triu_sum[rows1]))
-            loss_tril = -torch.mean(torch.log(tril_elements / tril_sum[cols2]))
-
-            loss += loss_diag1 + loss_diag2
-            loss_terms = 2
-
-            if len(rows1) > 0:
-                loss += loss_triu
-                loss_terms += 1
-            if len(rows2) > 0:
-                loss += loss_tril
-                loss_terms += 1
-            ncombinations += 1
-
-        loss = loss/(loss_terms*ncombinations)
-        return loss, sim_matrix_exp, torch.diag(torch.ones_like(sim_matrix_exp))
+        # pairs of different samples that belong to the same patient are extra positives
+        _, pids = np.unique(np.asarray(patientIds), return_inverse=True)
+        pids = torch.as_tensor(pids, device=features.device)
+        same_patient = pids.unsqueeze(0) == pids.unsqueeze(1)
+
+        rows1, cols1 = torch.triu(same_patient, diagonal=1).nonzero(as_tuple=True)
+        rows2, cols2 = torch.tril(same_patient, diagonal=-1).nonzero(as_tuple=True)
+
+        # every pair of views is scored in one batched matmul, stacked along the first dim
+        nviews = features.shape[1]
+        if nviews not in self.view_pairs:
+            self.view_pairs[nviews] = torch.tensor(list(combinations(range(nviews), 2)), device=features.device)
+        view_pairs = self.view_pairs[nviews]
+        view1_array = features[:, view_pairs[:, 0], :].transpose(0, 1)
+        view2_array = features[:, view_pairs[:, 1], :].transpose(0, 1)
+
+        # features are L2 normalized in train(), so the dot product already is the cosine similarity
+        sim_matrix = torch.bmm(view1_array, view2_array.transpose(1, 2))
+
+        temperature=0.1
+        # keep the InfoNCE terms in fp32 when running under autocast
+        argument = sim_matrix.float() / temperature
+
+        # log(exp(a_ij) / sum_k exp(a_ik)) = a_ij - logsumexp_k(a_ik)
+        triu_lse = torch.logsumexp(argument, dim=2)
+        tril_lse = torch.logsumexp(argument, dim=1)
+        diag_elements = torch.diagonal(argument, dim1=1, dim2=2)
+
+        # every pair contributes the same number of elements, so the mean over the
+        # stacked pairs equals the average of the per-pair means
+        loss_diag1 = -torch.mean(diag_elements - triu_lse)
+        loss_diag2 = -torch.mean(diag_elements - tril_lse)
+
+        loss_triu = -torch.mean(argument[:, rows1, cols1] - triu_lse[:, rows1])
+        loss_tril = -torch.mean(argument[:, rows2, cols2] - tril_lse[:, cols2])
+
+        loss = loss_diag1 + loss_diag2
+        loss_terms = 2
+
+        if len(rows1) > 0:
+            loss += loss_triu
+            loss_terms += 1
+        if len(rows2) > 0:
+            loss += loss_tril
+            loss_terms += 1
+
+        loss = loss/loss_terms
+        # the positive for row i of the similarity matrix is column i
+        logits = argument[-1]
+        labels = torch.arange(logits.shape[0], device=logits.device)
+        return loss, logits, labels
 
 
     def train(self, train_loader):
 
-        scaler = GradScaler(enabled=self.fp16_precision)
-
         # save config file
         # save_config_file(self.writer.log_dir, self.args)
 
@@ -170,15 +206,14 @@ class SimCLR(object):
 
         for epoch_counter in range(self.curr_epochs+1, self.epochs):
             print(f"Epoch {epoch_counter}")
-            for images, patientIds in tqdm(train_loader):
-                if images[0].shape[-1] == 5000:
-                    images1 = torch.cat([images[0][:,:,2500:], images[0][:,:,:2500]], dim=1).to(device)
-                    images2 = torch.cat([images[1][:,:,2500:], images[1][:,:,:2500]], dim=1).to(device)
-                else:
-                    images1 = images[0].to(device)
-                    images2 = images[1].to(device)
-
-                with autocast(enabled=self.fp16_precision):
+            for images, patientIds in tqdm(CUDAPrefetcher(train_loader)):
+                images1, images2 = images
+                if images1.shape[-1] == 5000:
+                    # split the 10s recordings into two 5s halves stacked along the lead dim
+                    images1 = torch.cat(images1.split(2500, dim=2)[::-1], dim=1)
+                    images2 = torch.cat(images2.split(2500, dim=2)[::-1], dim=1)
+
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=self.bf16_precision):
                     features1 = self.model(images1)
                     features2 = self.model(images2)
                     features = torch.cat([features1, features2], dim=1)
@@ -187,12 +222,13 @@ class SimCLR(object):
 
                 self.optimizer.zero_grad()
 
-                scaler.scale(loss).backward()
-
-                scaler.step(self.optimizer)
-                scaler.update()
-                loss_meter.update(loss.item(), images1.size(0))
-                if n_iter % 1 == 0:
+                loss.backward()
+                self.optimizer.step()
+                # kept on the device (in float64, the sum runs over the whole training), it is only synced when
+                # written to tensorboard
+                loss_meter.update(loss.detach().double(), images1.size(0))
+                # the metrics below sync with the device, so only compute them every few steps
+                if n_iter % self.log_every == 0:
                     top1, top5 = accuracy(logits, labels, topk=(1, 5))
                     acc1_meter.update(top1[0], images1.size(0))
                     acc5_meter.update(top5[0], images1.size(0))
@@ -214,6 +250,7 @@ class SimCLR(object):
                 save_checkpoint({
                     'epoch': epoch_counter,
                     'arch': self.args.arch,
+                    'bn_before_activation': getattr(self.model.module, 'bn_before_activation', None),
                     'state_dict': self.model.state_dict(),
                     'optimizer': self.optimizer.state_dict(),
                 }, is_best=False, filename=os.path.join(self.writer.log_dir, checkpoint_name))
@@ -49,10 +49,10 @@ def seed_everything(seed=42):
     torch.backends.cudnn.benchmark = True
 
 
-def create_model(args, baseline, finetune=False):
+def create_model(args, baseline, finetune=False, bn_before_activation=True):
     print("=> Creating Model")
     if args.arch == "BaselineConvNet":
-        model = Networks.BaselineConvNet(classification=True, avg_embeddings=True)
+        model = Networks.BaselineConvNet(classification=True, avg_embeddings=True, bn_before_activation=bn_before_activation)
     elif args.arch =="ECG_SpatioTemporalNet1D":
         model = Networks.ECG_SpatioTemporalNet1D(**parameters.spatioTemporalParams_1D, classification=True, avg_embeddings=True)
 
@@ -94,6 +94,12 @@ def main():
 
     results = {seed: [] for seed in seeds}
 
+    # match the batch norm ordering of the pretrained checkpoint, also for the baseline so both runs share an
+    # architecture. Checkpoints saved before the option existed were trained with batch norm after the activation
+    bn_before_activation = True
+    if args.arch == "BaselineConvNet" and args.pretrained is not None:
+        bn_before_activation = torch.load(args.pretrained, map_location="cpu").get('bn_before_activation', False)
+
     results_file = f"results_{args.task}_{args.pretrained.split('/')[1]}_ep_{args.pretrained.split('/')[2].split('.')[0][-4:]}"
 
     writer = SummaryWriter(log_dir=f"classification_runs/{results_file}")
@@ -127,18 +133,18 @@ def main():
             for x in [0,1,2]:
                 print(f"Training on {training_size} ECGs and validation on {len(val_loader.dataset)} ECGs.")
                 if x == 0:
-                    model = create_model(args, baseline=True)
+                    model = create_model(args, baseline=True, bn_before_activation=bn_before_activation)
                     lr = args.lr[0]
                     key = f"Baseline"
                     print(f"Training Baseline Model")
                     
                 elif x == 1:
-                    model = create_model(args, baseline=False, finetune=False)
+                    model = create_model(args, baseline=False, finetune=False, bn_before_activation=bn_before_activation)
                     lr = args.lr[1]
                     key = f"PreTrained/Frozen"
                     print(f"Training Pretrained Model with Frozen Parameters")
                 elif x == 2:
-                    model = create_model(args, baseline=False, finetune=True)
+                    model = create_model(args, baseline=False, finetune=True, bn_before_activation=bn_before_activation)
                     fast_lr = args.lr[1]
                     slow_lr = args.lr[2]
                     key = f"PreTrained/Finetuned"
@@ -31,12 +31,14 @@ def main(args):
     shuffle=False,
     )
 
-    model = Networks.BaselineConvNet(classification=False, avg_embeddings=True)
-    model.finalLayer = nn.Identity()
-
     checkpoint = tch.load(args["pretrained"], map_location="cpu")
     state_dict = checkpoint['state_dict']
 
+    # checkpoints saved before the option existed were trained with batch norm after the activation
+    model = Networks.BaselineConvNet(classification=False, avg_embeddings=True,
+                                     bn_before_activation=checkpoint.get('bn_before_activation', False))
+    model.finalLayer = nn.Identity()
+
     for k in list(state_dict.keys()):
         # retain only encoder_q up to before the embedding layer
         if k.startswith("module.") and not k.startswith(
@@ -50,11 +52,17 @@ def main(args):
 
     msg = model.load_state_dict(state_dict, strict=True)
     print(f"There are {len(msg.missing_keys)} missing keys")
-    
+
+    model.eval()
+    model.fuse_for_eval()
+    # with the norms folded away each block is conv -> bias -> leaky relu, which inductor fuses into the conv epilogue.
+    # DataParallel replicas would still call the module compiled for the first device, so only compile on one GPU
+    if len(gpuIds) <= 1:
+        model.compile()
+
     model = tch.nn.DataParallel(model, device_ids=gpuIds)   
     print(model)
     model.to(device)
-    model.eval()
 
     outputs = None
     labels = None
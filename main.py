@@ -26,6 +26,7 @@ parser.add_argument('--temperature', default=0.1, type=float, metavar='T', help=
 parser.add_argument('--checkpoint_freq', default=10, type=int, metavar='N', help='Frequency of saving checkpoints')
 parser.add_argument('--warmup_epochs', default=50, type=int, metavar='N', help='Number of warmup epochs')
 parser.add_argument('--arch', default='ECG_SpatioTemporalNet1D', choices=["ECG_SpatioTemporalNet1D", "BaselineConvNet"], type=str, metavar='ARCH', help='Architecture to use')
+parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile')
 parser.add_argument('--data', default='LVEF', choices=["1M", "LVEF"], type=str, metavar='DATA', help='Data to use')
 
 
@@ -107,16 +108,22 @@ def main():
     print(f"Number of ECGs in dataset: {len(dataset)}")
     train_loader = torch.utils.data.DataLoader(
         dataset, batch_size=batch_size, shuffle=True,
-        num_workers=32, pin_memory=True, drop_last=True)
+        num_workers=32, pin_memory=True, drop_last=True, persistent_workers=True)
     print(f"DataLoader creation time: {time.time() - start} seconds")
 
-    model = Networks.BaselineConvNet(lead_grouping=lead_groupings) if args.arch == "BaselineConvNet" else Networks.ECG_SpatioTemporalNet1D(**parameters.spatioTemporalParams_1D)
-    optimizer = torch.optim.Adam(model.parameters(), lr)
+    model = Networks.BaselineConvNet(lead_grouping=lead_groupings, bn_before_activation=True) if args.arch == "BaselineConvNet" else Networks.ECG_SpatioTemporalNet1D(**parameters.spatioTemporalParams_1D)
+    # the fused Adam kernel needs the parameters on the GPU when it is created
+    model.to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr, fused=torch.cuda.is_available())
 
     if args.pretrained is not None:
         if os.path.exists(args.pretrained):
             print(f"Loading pretrained model from {args.pretrained}")
             checkpoint = torch.load(args.pretrained)
+            if args.arch == "BaselineConvNet":
+                # checkpoints saved before the option existed were trained with batch norm after the activation
+                assert checkpoint.get('bn_before_activation', False) == model.bn_before_activation, \
+                    f"{args.pretrained} was trained with a different batch norm ordering and cannot be resumed"
             state_dict = checkpoint['state_dict']
             for k in list(state_dict.keys()):
                 if k.startswith("module."):
@@ -135,6 +142,13 @@ def main():
             return
 
     print(model.finalLayer)
+    if args.compile:
+        # compiled in place so checkpoint keys stay the same; DataParallel replicas would still call the
+        # module compiled for the first device, so this is only done for single GPU runs
+        if len(gpuIds) <= 1:
+            model.compile(mode='max-autotune', dynamic=False)
+        else:
+            print(f"Skipping torch.compile, it is not supported with DataParallel over {len(gpuIds)} GPUs")
     model = torch.nn.DataParallel(model, device_ids=gpuIds)
     model.to(device)
     